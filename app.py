@@ -1,7 +1,16 @@
 import os
+import math
+import stat
+import threading
+import hashlib
+import time
+from pathlib import Path
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow.parquet as pq
 from google.cloud import bigquery
+from google.cloud import bigquery_storage
 from datetime import date
 import plotly.express as px
 
@@ -17,125 +26,225 @@ with tempfile.NamedTemporaryFile(delete=False, mode="w", suffix=".json") as f:
 
 st.set_page_config(page_title="Time to Hire & CAC", layout="wide")
 
-# --- Load Main Data ---
-@st.cache_data
-def load_main_data():
-    client = bigquery.Client()
+month_lookup = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+# --- Shared Clients ---
+@st.cache_resource
+def get_bq():
+    return bigquery.Client()
+
+# Read query results over the Storage API (Arrow) instead of the REST row API
+@st.cache_resource
+def get_bqstorage():
+    return bigquery_storage.BigQueryReadClient()
+
+# --- On-disk Query Cache ---
+# Survives process restarts, unlike st.cache_data, so a fresh container skips the BigQuery round trip.
+# A result can sit in a Parquet file and then again in st.cache_data, so each layer gets half of DATA_TTL
+# and no query result is served more than DATA_TTL after it was fetched. The country index is rebuilt
+# from the options query on its own TTL, so it can trail that query by up to another DATA_TTL // 2.
+DATA_TTL = 3600
+BQ_CACHE_TTL = DATA_TTL // 2
+BQ_CACHE_DIR = Path(tempfile.gettempdir()) / "bqcache"
+
+# Files hold row-level data, so the shared temp dir is only used if nobody else owns or can write to it
+def bq_cache_dir_is_private():
+    try:
+        BQ_CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+        info = BQ_CACHE_DIR.lstat()
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o022:
+            return False
+        BQ_CACHE_DIR.chmod(0o700)
+    except OSError:
+        return False
+    return True
+
+# Leftover *.tmp files are from writes that crashed before the rename; live writes are always fresh
+def prune_bq_cache():
+    for pattern in ["*.parquet", "*.tmp"]:
+        for cached_file in BQ_CACHE_DIR.glob(pattern):
+            try:
+                if time.time() - cached_file.stat().st_mtime >= BQ_CACHE_TTL:
+                    cached_file.unlink()
+            except FileNotFoundError:
+                pass
+
+def cached_bq(query, query_parameters=()):
+    key = json.dumps([query, [p.to_api_repr() for p in query_parameters]], sort_keys=True, default=str)
+    path = BQ_CACHE_DIR / f"{hashlib.sha256(key.encode()).hexdigest()}.parquet"
+    use_disk = bq_cache_dir_is_private()
+    if use_disk:
+        # Another session's prune can remove the file at any point, which is just a cache miss
+        try:
+            if time.time() - path.stat().st_mtime < BQ_CACHE_TTL:
+                return pq.read_table(path).to_pandas()
+        except FileNotFoundError:
+            pass
+    client = get_bq()
+    job_config = bigquery.QueryJobConfig(query_parameters=list(query_parameters))
+    table = client.query(query, job_config=job_config).to_arrow(bqstorage_client=get_bqstorage())
+    if use_disk:
+        prune_bq_cache()
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        pq.write_table(table, tmp_path)
+        tmp_path.replace(path)
+    return table.to_pandas()
+
+# --- Load Filter Options ---
+@st.cache_data(ttl=DATA_TTL // 2)
+def load_filter_options():
     query = """
-        SELECT 
-            User_ID,
-            `Application Created` AS application_date,
-            `Successful_Date` AS successful_date,
-            `Location Category Updated` AS location_category,
+        SELECT
             `Nationality Category Updated` AS nationality_category,
-            `Country Updated` AS country
+            `Location Category Updated` AS location_category,
+            `Country Updated` AS country,
+            MIN(DATE_TRUNC(DATE(SAFE_CAST(`Application Created` AS DATETIME)), MONTH)) AS min_month,
+            MAX(DATE_TRUNC(DATE(SAFE_CAST(`Application Created` AS DATETIME)), MONTH)) AS max_month
         FROM `data-driven-attributes.AT_marketing_db.ATD_New_Last_Action_by_User_PivotData_View`
-        WHERE `Application Created` IS NOT NULL
+        WHERE SAFE_CAST(`Application Created` AS DATETIME) IS NOT NULL
+        GROUP BY nationality_category, location_category, country
     """
-    df = client.query(query).to_dataframe()
-    df['application_date'] = pd.to_datetime(df['application_date'], errors='coerce')
-    df['successful_date'] = pd.to_datetime(df['successful_date'], errors='coerce')
-    return df.dropna(subset=['application_date'])
+    options_df = cached_bq(query)
+    options_df['min_month'] = pd.to_datetime(options_df['min_month']).dt.date
+    options_df['max_month'] = pd.to_datetime(options_df['max_month']).dt.date
+    return options_df
+
+@st.cache_data(ttl=DATA_TTL // 2)
+def load_country_index():
+    options_df = load_filter_options()
+    return {
+        key: tuple(sorted(group.dropna().unique()))
+        for key, group in options_df.groupby(['nationality_category', 'location_category'])['country']
+    }
+
+# --- Compute Time to Hire ---
+# Months since Jan 1970, so month differences are plain integer subtraction and mi % 12 is the calendar month
+def month_index(dates):
+    return np.asarray(dates, dtype='datetime64[M]').astype(np.int32)
+
+def compute_time_to_hire(hire_offsets, num_months=12):
+    total_hires = len(hire_offsets)
+    if total_hires == 0:
+        return [0.0] * num_months
+    offset = hire_offsets[(hire_offsets >= 0) & (hire_offsets < num_months)]
+    bracket_counts = np.bincount(offset, minlength=num_months)
+    return (bracket_counts / total_hires).tolist()
 
-df = load_main_data()
-df['app_month'] = df['application_date'].dt.to_period("M").dt.to_timestamp()
-df['app_month_date'] = df['app_month'].dt.date
-df['month_name'] = df['application_date'].dt.strftime("%b")
-df['year'] = df['application_date'].dt.year
+# --- Month-wise Brackets ---
+def compute_brackets(hire_offsets, hire_month_codes):
+    month_totals = np.bincount(hire_month_codes, minlength=12)
+    in_window = (hire_offsets >= 0) & (hire_offsets < 12)
+    month_counts = np.bincount(
+        hire_month_codes[in_window] * 12 + hire_offsets[in_window], minlength=12 * 12
+    ).reshape(12, 12)
+    return month_counts / np.maximum(month_totals, 1)[:, None]
+
+# --- Load Dashboard Data ---
+# Main, spend and hire rows come back from one job, tagged by `kind`, and are split apart in pandas
+MAIN_COLUMNS = ['application_date', 'successful_date']
+SPEND_COLUMNS = ['spend_month', 'monthly_spend']
+HIRE_COLUMNS = ['hire_month', 'hires']
+
+@st.cache_data(ttl=DATA_TTL // 2)
+def load_dashboard_data(nationality, location, countries, start_month, end_month):
+    query = """
+        WITH main AS (
+            SELECT
+                SAFE_CAST(`Application Created` AS DATETIME) AS application_date,
+                SAFE_CAST(`Successful_Date` AS DATETIME) AS successful_date
+            FROM `data-driven-attributes.AT_marketing_db.ATD_New_Last_Action_by_User_PivotData_View`
+            WHERE SAFE_CAST(`Application Created` AS DATETIME) IS NOT NULL
+              AND `Nationality Category Updated` = @nationality
+              AND `Location Category Updated` = @location
+              AND `Country Updated` IN UNNEST(@countries)
+              AND DATE_TRUNC(DATE(SAFE_CAST(`Application Created` AS DATETIME)), MONTH) BETWEEN @start_month AND @end_month
+        ),
+        spend AS (
+            SELECT
+                DATETIME(DATE_TRUNC(application_created_date, MONTH)) AS spend_month,
+                SUM(total_spend_aed) AS monthly_spend
+            FROM `data-driven-attributes.AT_marketing_db.AT_Country_Daily_Performance_Spend_ERP_Updated`
+            WHERE nationality_category = @nationality
+              AND location_category = @location
+              AND country_name IN UNNEST(@countries)
+            GROUP BY spend_month
+        ),
+        hire AS (
+            SELECT
+              DATETIME(DATE_TRUNC(DATE(Successful_Date), MONTH)) AS hire_month,
+              COUNT(*) AS hires
+            FROM `data-driven-attributes.AT_marketing_db.ATD_New_Last_Action_by_User_PivotData_View`
+            WHERE Successful_Date IS NOT NULL
+              AND `Nationality Category Updated` = @nationality
+              AND `Location Category Updated` = @location
+              AND `Country Updated` IN UNNEST(@countries)
+            GROUP BY hire_month
+        )
+        SELECT 'main' AS kind, application_date, successful_date,
+               NULL AS spend_month, NULL AS monthly_spend, NULL AS hire_month, NULL AS hires
+        FROM main
+        UNION ALL
+        SELECT 'spend', NULL, NULL, spend_month, monthly_spend, NULL, NULL
+        FROM spend
+        UNION ALL
+        SELECT 'hire', NULL, NULL, NULL, NULL, hire_month, hires
+        FROM hire
+    """
+    query_parameters = [
+        bigquery.ScalarQueryParameter('nationality', 'STRING', nationality),
+        bigquery.ScalarQueryParameter('location', 'STRING', location),
+        bigquery.ArrayQueryParameter('countries', 'STRING', list(countries)),
+        bigquery.ScalarQueryParameter('start_month', 'DATE', start_month),
+        bigquery.ScalarQueryParameter('end_month', 'DATE', end_month),
+    ]
+    data = cached_bq(query, query_parameters)
+
+    # Only hired rows feed the brackets and box plots, so derive their per-row columns once here
+    main_df = data.loc[data['kind'] == 'main', MAIN_COLUMNS]
+    hired_df = main_df[main_df['successful_date'].notna()].reset_index(drop=True)
+    hired_df['month_name'] = pd.Categorical.from_codes(hired_df['application_date'].dt.month.to_numpy() - 1, categories=month_lookup, ordered=True)
+    hired_df['year'] = hired_df['application_date'].dt.year
+    hired_df['hire_offset'] = month_index(hired_df['successful_date']) - month_index(hired_df['application_date'])
+    hired_df['time_to_hire_days'] = (hired_df['successful_date'] - hired_df['application_date']).dt.days.astype(np.int32)
+
+    # Brackets always cover 12 months, so moving the num_months slider only re-slices the cached result
+    hire_offsets = hired_df['hire_offset'].to_numpy()
+    overall_brackets = compute_time_to_hire(hire_offsets, 12)
+    month_bracket_matrix = compute_brackets(hire_offsets, hired_df['month_name'].cat.codes.to_numpy(dtype=np.int32))
+
+    spend_df = data.loc[data['kind'] == 'spend', SPEND_COLUMNS].reset_index(drop=True)
+    hire_df = data.loc[data['kind'] == 'hire', HIRE_COLUMNS].reset_index(drop=True)
+    hire_df['hires'] = hire_df['hires'].astype(np.int32)
+    return hired_df, spend_df, hire_df, overall_brackets, month_bracket_matrix
+
+options_df = load_filter_options()
 
 # --- Sidebar filters ---
 st.sidebar.header("Filters")
-nationality = st.sidebar.selectbox("Nationality Category", sorted(df['nationality_category'].dropna().unique()))
-location = st.sidebar.selectbox("Location Category", sorted(df['location_category'].dropna().unique()))
+nationality = st.sidebar.selectbox("Nationality Category", sorted(options_df['nationality_category'].dropna().unique()))
+location = st.sidebar.selectbox("Location Category", sorted(options_df['location_category'].dropna().unique()))
 
 # Show month slider before country
-min_month = df['app_month_date'].min()
-max_month = df['app_month_date'].max()
+min_month = options_df['min_month'].min()
+max_month = options_df['max_month'].max()
 selected_month_range = st.sidebar.slider("Application Month Range", min_value=min_month, max_value=max_month, value=(min_month, max_month), format="MMM YYYY")
 num_months = st.sidebar.slider("Months to Track After Application", min_value=1, max_value=12, value=6)
 
-available_countries = sorted(df[(df['nationality_category'] == nationality) & (df['location_category'] == location)]['country'].dropna().unique())
+available_countries = list(load_country_index().get((nationality, location), ()))
 countries = st.sidebar.multiselect("Country", available_countries, default=available_countries)
 
-filtered_df = df[
-    (df['nationality_category'] == nationality) &
-    (df['location_category'] == location) &
-    (df['country'].isin(countries)) &
-    (df['app_month_date'] >= selected_month_range[0]) &
-    (df['app_month_date'] <= selected_month_range[1])
-]
+hired_df, spend_df, hire_df, overall_brackets, month_bracket_matrix = load_dashboard_data(
+    nationality, location, tuple(countries), selected_month_range[0], selected_month_range[1]
+)
+spend_df = spend_df.sort_values('spend_month', ignore_index=True)
+month_wise_brackets = dict(zip(month_lookup, month_bracket_matrix.tolist()))
 
-# --- Compute Time to Hire ---
-def compute_time_to_hire(df, num_months=12):
-    df = df[df['successful_date'].notna()].copy()
-    df['application_month'] = df['application_date'].dt.to_period("M").dt.to_timestamp()
-    df['hire_month'] = df['successful_date'].dt.to_period("M").dt.to_timestamp()
-    total_hires = len(df)
-    bracket_counts = [0] * num_months
-    for cohort_month, group in df.groupby('application_month'):
-        for offset in range(num_months):
-            start = cohort_month + pd.DateOffset(months=offset)
-            end = cohort_month + pd.DateOffset(months=offset + 1)
-            count = group[(group['hire_month'] >= start) & (group['hire_month'] < end)].shape[0]
-            bracket_counts[offset] += count
-    return [(c / total_hires if total_hires > 0 else 0) for c in bracket_counts]
-
-# --- Month-wise Brackets ---
-month_lookup = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
-month_wise_brackets = {}
-for month in month_lookup:
-    month_data = filtered_df[filtered_df['month_name'] == month]
-    month_wise_brackets[month] = compute_time_to_hire(month_data, 12) if not month_data.empty else [0.0] * 12
-
-# --- Load Spend Data ---
-@st.cache_data
-def load_spend_data():
-    client = bigquery.Client()
-    query = """
-        SELECT
-            DATE_TRUNC(application_created_date, MONTH) AS spend_month,
-            country_name,
-            nationality_category,
-            location_category,
-            SUM(total_spend_aed) AS monthly_spend
-        FROM `data-driven-attributes.AT_marketing_db.AT_Country_Daily_Performance_Spend_ERP_Updated`
-        GROUP BY spend_month, country_name, nationality_category, location_category
-    """
-    return client.query(query).to_dataframe()
-
-spend_df = load_spend_data()
-spend_df['spend_month'] = pd.to_datetime(spend_df['spend_month']).dt.to_period('M').dt.to_timestamp()
-spend_df = spend_df[
-    (spend_df['nationality_category'] == nationality) &
-    (spend_df['location_category'] == location) &
-    (spend_df['country_name'].isin(countries))
-]
-spend_df = spend_df.groupby('spend_month', as_index=False)['monthly_spend'].sum()
-
-# --- Load Hire Data ---
-@st.cache_data
-def load_hire_data():
-    client = bigquery.Client()
-    query = """
-        SELECT
-          DATE_TRUNC(DATE(Successful_Date), MONTH) AS hire_month,
-          `Country Updated` AS country,
-          `Location Category Updated` AS location_category,
-          `Nationality Category Updated` AS nationality_category,
-          COUNT(*) AS hires
-        FROM `data-driven-attributes.AT_marketing_db.ATD_New_Last_Action_by_User_PivotData_View`
-        WHERE Successful_Date IS NOT NULL
-        GROUP BY hire_month, country, location_category, nationality_category
-    """
-    return client.query(query).to_dataframe()
-
-hire_df = load_hire_data()
-hire_df = hire_df[
-    (hire_df['country'].isin(countries)) &
-    (hire_df['location_category'] == location) &
-    (hire_df['nationality_category'] == nationality)
-]
-hire_df['hire_month'] = pd.to_datetime(hire_df['hire_month']).dt.to_period("M").dt.to_timestamp()
+# --- Compute CAC ---
+# Row i of the matrices covers hire month i, column j the spend month j months before it
+def compute_cac(spend_matrix, weight_matrix, hires):
+    weighted_spend = np.einsum('ij,ij->i', spend_matrix, weight_matrix)
+    cac = np.divide(weighted_spend, hires, out=np.full(len(hires), np.nan), where=hires > 0)
+    return weighted_spend, cac
 
 # --- TABS ---
 tab1, tab2, tab3, tab4 = st.tabs(["Overall Summary", "Monthly Drilldown", "Spend Overview", "Cost Calculator"])
@@ -144,14 +253,17 @@ with tab1:
     st.title("Overall Summary")
     summary = pd.DataFrame({
         'Time Bracket': [f"End of {i+1} Month{'s' if i > 0 else ''}" for i in range(num_months)],
-        'Percentage of Total Hires': [f"{p * 100:.1f}%" for p in compute_time_to_hire(filtered_df, num_months)]
+        'Percentage of Total Hires': [f"{p * 100:.1f}%" for p in overall_brackets[:num_months]]
     })
     st.dataframe(summary, use_container_width=True)
 
-    box_df = filtered_df[filtered_df['successful_date'].notna()].copy()
-    box_df['time_to_hire_days'] = (box_df['successful_date'] - box_df['application_date']).dt.days
-    for y in sorted(box_df['year'].unique()):
-        fig = px.box(box_df[box_df['year'] == y], x='month_name', y='time_to_hire_days', title=f"Time to Hire by Month — {y}")
+    if not hired_df.empty:
+        years = sorted(hired_df['year'].unique())
+        fig = px.box(
+            hired_df, x='month_name', y='time_to_hire_days', facet_col='year', facet_col_wrap=3,
+            category_orders={'month_name': month_lookup, 'year': years},
+            title="Time to Hire by Month", height=350 * math.ceil(len(years) / 3)
+        )
         st.plotly_chart(fig, use_container_width=True)
 
 with tab2:
@@ -171,25 +283,28 @@ with tab3:
 
 with tab4:
     st.title("Cost Calculator")
-    cac_rows = []
-
-    for hire_month in sorted(hire_df['hire_month'].dropna().unique()):
-        hires = int(hire_df[hire_df['hire_month'] == hire_month]['hires'].sum())
-        weighted_spend = 0
-        for i in range(12):
-            spend_month = (hire_month - pd.DateOffset(months=i)).to_period('M').to_timestamp()
-            spend = spend_df[spend_df['spend_month'] == spend_month]['monthly_spend'].sum()
-            month_name = spend_month.strftime("%b")
-            weight = month_wise_brackets.get(month_name, [0]*12)[i]
-            weighted_spend += spend * weight
-        cac = (weighted_spend / hires) if hires > 0 else None
-        cac_rows.append({
-            'Hire Month': hire_month.strftime('%Y-%m'),
-            'Total Hires': hires,
-            'Weighted Spend (AED)': round(weighted_spend, 2),
-            'CAC (AED per Hire)': round(cac, 2) if cac is not None else 'N/A'
-        })
+    hires_by_month = hire_df.groupby('hire_month')['hires'].sum()
+    spend_by_month = spend_df.groupby('spend_month')['monthly_spend'].sum()
+    hire_months = hires_by_month.index
 
-    cac_df = pd.DataFrame(cac_rows)
+    # Column i holds the spend (and its bracket weight) from i months before each hire month
+    hire_mi = month_index(hire_months)
+    spend_mi = hire_mi[:, None] - np.arange(12)
+    spend_vec = np.bincount(
+        month_index(spend_by_month.index),
+        weights=spend_by_month.to_numpy(dtype=float),
+        minlength=hire_mi.max(initial=0) + 1
+    )
+    spend_matrix = spend_vec[spend_mi]
+    weight_matrix = month_bracket_matrix[spend_mi % 12, np.arange(12)]
+
+    hires = hires_by_month.to_numpy(dtype=np.int32)
+    weighted_spend, cac = compute_cac(spend_matrix, weight_matrix, hires)
+    cac_df = pd.DataFrame({
+        'Hire Month': hire_months.strftime('%Y-%m'),
+        'Total Hires': hires,
+        'Weighted Spend (AED)': weighted_spend.round(2),
+        'CAC (AED per Hire)': pd.Series(cac.round(2), dtype=object).where(hires > 0, 'N/A')
+    })
     st.dataframe(cac_df, use_container_width=True)
     st.download_button("Download CAC Results", data=cac_df.to_csv(index=False), file_name="cac_results.csv", mime="text/csv")